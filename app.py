@@ -1,82 +1,490 @@
+# gevent must patch the standard library before anything else imports it, so
+# network calls (Sheets, Gemini) let other requests run while they wait.
+from gevent import monkey
+monkey.patch_all()
+
+import io
 import os
-import json
+import csv
+import orjson
+import hmac
+import heapq
+import tempfile
+import time
+import uuid
+import atexit
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import gspread
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import docx
-from io import BytesIO
 from flask import Flask, request, jsonify, send_file
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
+from cachetools import TTLCache
 
 # --- SETUP ---
 logging.basicConfig(level=logging.INFO)
+
+class ORJSONProvider(JSONProvider):
+    # Flask uses this for jsonify() and request.json. orjson is much faster
+    # than the standard json module, which matters for the big feedback list.
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app) 
+# Compress larger responses such as the feedback list. Brotli is used when
+# the client supports it, gzip otherwise. The DOCX report is left alone because
+# its mimetype is not in COMPRESS_MIMETYPES (a .docx is already a zip file).
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+Compress(app)
 
 # --- CONFIGURATION & CREDENTIALS ---
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+# Shared secret for admin-only routes, sent in the X-Admin-Token header. The routes are disabled when it's not set.
+ADMIN_API_TOKEN = os.environ.get('ADMIN_API_TOKEN')
+# How many Gemini calls one worker may have in flight at once. With gevent
+# workers these are cheap greenlets, so a burst of submissions or report
+# sections is sent in parallel instead of one after another.
+try:
+    GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', 16))
+except ValueError:
+    app.logger.error(f"Invalid GEMINI_MAX_CONCURRENCY {os.environ.get('GEMINI_MAX_CONCURRENCY')!r}, using 16.")
+    GEMINI_MAX_CONCURRENCY = 16
+if GEMINI_MAX_CONCURRENCY < 1:
+    app.logger.error(f"GEMINI_MAX_CONCURRENCY must be at least 1, got {GEMINI_MAX_CONCURRENCY}, using 1.")
+    GEMINI_MAX_CONCURRENCY = 1
 # We load the credentials once and store them.
 try:
-    GCP_CREDENTIALS = json.loads(os.environ.get('GCP_CREDENTIALS_JSON'))
+    GCP_CREDENTIALS = orjson.loads(os.environ.get('GCP_CREDENTIALS_JSON'))
 except Exception as e:
     app.logger.error(f"FATAL: Could not parse GCP_CREDENTIALS_JSON. Check the environment variable. Error: {e}")
     GCP_CREDENTIALS = None
 
 # --- DATABASE HELPER ---
-# This function connects to a specific sheet *when needed*. This is more robust.
-def get_sheet(worksheet_name):
+# We connect to Google Sheets the first time a sheet is needed, then reuse the
+# same client, spreadsheet and worksheets for later requests. The client
+# refreshes its access token by itself when it expires, and /health resets the
+# connection if it stops working.
+_spreadsheet = None
+_worksheets = {}
+_sheets_lock = threading.Lock()
+
+def get_spreadsheet():
+    global _spreadsheet
     if not GCP_CREDENTIALS:
         raise Exception("GCP credentials are not loaded.")
-    
+
     try:
-        gc = gspread.service_account_from_dict(GCP_CREDENTIALS)
-        spreadsheet = gc.open("PharmaFeedbackApp")
-        return spreadsheet.worksheet(worksheet_name)
+        with _sheets_lock:
+            if _spreadsheet is None:
+                gc = gspread.service_account_from_dict(GCP_CREDENTIALS)
+                _spreadsheet = gc.open("PharmaFeedbackApp")
+            return _spreadsheet
     except gspread.exceptions.SpreadsheetNotFound:
         raise Exception(f"Spreadsheet 'PharmaFeedbackApp' not found or not shared.")
+    except Exception as e:
+        raise Exception(f"A gspread error occurred: {e}")
+
+def get_sheet(worksheet_name):
+    spreadsheet = get_spreadsheet()
+    try:
+        with _sheets_lock:
+            worksheet = _worksheets.get(worksheet_name)
+            if worksheet is None:
+                worksheet = spreadsheet.worksheet(worksheet_name)
+                _worksheets[worksheet_name] = worksheet
+            return worksheet
     except gspread.exceptions.WorksheetNotFound:
         raise Exception(f"Worksheet '{worksheet_name}' not found in the spreadsheet.")
     except Exception as e:
         raise Exception(f"A gspread error occurred: {e}")
 
-# --- GEMINI HELPER FUNCTIONS (UNCHANGED) ---
-def analyze_with_gemini(text):
-    # ... (code is identical to your version)
+def reset_sheet_connection():
+    # Forget the cached connection so the next get_sheet() reconnects from scratch.
+    global _spreadsheet
+    with _sheets_lock:
+        _spreadsheet = None
+        _worksheets.clear()
+
+# --- CACHES ---
+# The dashboard reads the Feedback, Products and AdminUsers sheets. Each sheet
+# is cached on its own with its own lifetime. When several of them need
+# refreshing at once, they are fetched together in one batchGet call.
+SHEET_RANGES = {
+    "Feedback": "Feedback!A:I",
+    "Products": "Products!A:A",
+    "AdminUsers": "AdminUsers!A:C",
+}
+# Feedback changes with every submission, the other sheets are edited by hand.
+SHEET_CACHE_TTLS = {"Feedback": 60, "Products": 120, "AdminUsers": 300}
+_sheet_caches = {name: TTLCache(maxsize=1, ttl=ttl) for name, ttl in SHEET_CACHE_TTLS.items()}
+_sheet_caches_lock = threading.Lock()
+
+def batch_get_sheets(sheet_names):
+    # Fetches the given sheets with a single batchGet call and caches each one.
+    result = get_spreadsheet().values_batch_get([SHEET_RANGES[name] for name in sheet_names])
+    value_ranges = result.get('valueRanges', [])
+    sheets = {name: value_range.get('values', []) for name, value_range in zip(sheet_names, value_ranges)}
+    with _sheet_caches_lock:
+        for name, values in sheets.items():
+            _sheet_caches[name][name] = values
+    return sheets
+
+def _cached_sheet_values(sheet_name):
+    with _sheet_caches_lock:
+        return _sheet_caches[sheet_name].get(sheet_name)
+
+def load_sheet_values(sheet_name):
+    _check_cache_generation()
+    values = _cached_sheet_values(sheet_name)
+    if values is not None:
+        return values
+    # The small sheets that have expired too are refreshed in the same call.
+    # Feedback is only fetched when it is the sheet being asked for, because it
+    # is by far the biggest.
+    sheet_names = [sheet_name] + [name for name in ("Products", "AdminUsers") if name != sheet_name and _cached_sheet_values(name) is None]
+    return batch_get_sheets(sheet_names)[sheet_name]
+
+def clear_sheet_cache(*sheet_names):
+    # Clears the given sheets, or all of them when none are given.
+    with _sheet_caches_lock:
+        for name in sheet_names or SHEET_RANGES:
+            _sheet_caches[name].clear()
+
+# Each gunicorn worker has its own caches. To clear all of them at once,
+# /invalidate-cache touches this file, and every worker compares its
+# modification time with the last one it saw before reading a cached sheet.
+CACHE_GENERATION_FILE = os.path.join(tempfile.gettempdir(), 'pharma-feedback-cache-generation')
+
+def _cache_generation():
+    try:
+        return os.stat(CACHE_GENERATION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+_seen_cache_generation = _cache_generation()
+
+def _check_cache_generation():
+    global _seen_cache_generation
+    generation = _cache_generation()
+    if generation != _seen_cache_generation:
+        _seen_cache_generation = generation
+        clear_sheet_cache()
+
+def invalidate_all_sheet_caches():
+    with open(CACHE_GENERATION_FILE, 'a'):
+        pass
+    os.utime(CACHE_GENERATION_FILE)
+    clear_sheet_cache()
+
+def _pad_row(row, width):
+    # The API leaves out empty cells at the end of a row.
+    return row + [""] * (width - len(row))
+
+def _load_table(sheet_name):
+    # Returns the header row and the data rows as plain lists of strings.
+    values = load_sheet_values(sheet_name)
+    if not values:
+        return [], []
+    headers = values[0]
+    return headers, [_pad_row(row, len(headers)) for row in values[1:]]
+
+def _load_records(sheet_name):
+    # Like worksheet.get_all_records(), but read from the batched values and without number conversion.
+    headers, rows = _load_table(sheet_name)
+    return [dict(zip(headers, row)) for row in rows]
+
+def _load_products():
+    return [row[0] if row else "" for row in load_sheet_values("Products")[1:]]
+
+def _load_admins():
+    return {str(user['Username']): str(user['Password']) for user in _load_records("AdminUsers")}
+
+# Users often submit the same feedback again with different spacing or casing.
+# We remember the AI analysis per product for an hour so those repeats don't
+# cost another Gemini call. Punctuation and emoji are kept in the key because
+# they can change the meaning ("Good?" vs "Good!").
+_analysis_cache = TTLCache(maxsize=1024, ttl=3600)
+_analysis_lock = threading.Lock()
+# Analyses currently waiting on Gemini, so identical feedback arriving at the
+# same time shares one call instead of making its own.
+_inflight_analyses = {}
+
+def _analysis_key(text, namespace):
+    normalized = " ".join(text.lower().split())
+    return (namespace or "", normalized)
+
+# --- FEEDBACK WRITER ---
+# Writing one row per request costs one Sheets API call each time and quickly
+# hits the write quota. Instead, new rows go into a queue and a background
+# thread writes them in batches with a single append_rows call.
+# Column order of the Feedback sheet, as written by _process_feedback. Rows
+# are read back by position, so renaming a header in the sheet breaks nothing.
+FEEDBACK_COLUMNS = ["timestamp", "productName", "feedbackText", "suggestionText", "clientName", "clientEmail", "category", "sentiment", "error"]
+_FEEDBACK_COLUMN_INDEX = {name: index for index, name in enumerate(FEEDBACK_COLUMNS)}
+
+def feedback_cell(row, column_name):
+    index = _FEEDBACK_COLUMN_INDEX[column_name]
+    return row[index] if index < len(row) else ''
+
+FEEDBACK_FLUSH_INTERVAL = 2  # seconds
+FEEDBACK_BATCH_SIZE = 100
+# While Sheets is failing (e.g. the per-minute write quota is used up) we keep
+# the rows and retry with a growing delay. Rows are only dropped, and logged,
+# once the queue is full.
+FEEDBACK_MAX_RETRY_DELAY = 60  # seconds
+FEEDBACK_MAX_QUEUED_ROWS = 10000
+_feedback_queue = deque()
+_feedback_queue_lock = threading.Lock()
+_feedback_flush_event = threading.Event()
+_feedback_flush_lock = threading.Lock()
+
+def _log_dropped_feedback_rows(rows, reason):
+    for row in rows:
+        app.logger.error(f"Dropped feedback row ({reason}): {row}")
+
+def queue_feedback_row(row):
+    with _feedback_queue_lock:
+        is_full = len(_feedback_queue) >= FEEDBACK_MAX_QUEUED_ROWS
+        if not is_full:
+            _feedback_queue.append(row)
+        queued_rows = len(_feedback_queue)
+    if is_full:
+        _log_dropped_feedback_rows([row], "queue is full")
+    elif queued_rows >= FEEDBACK_BATCH_SIZE:
+        _feedback_flush_event.set()
+
+def flush_feedback_rows():
+    # Writes everything currently queued. If a write fails, its rows go back to
+    # the front of the queue so they are retried first and keep their order.
+    with _feedback_flush_lock:
+        while True:
+            with _feedback_queue_lock:
+                rows = [_feedback_queue.popleft() for _ in range(min(FEEDBACK_BATCH_SIZE, len(_feedback_queue)))]
+            if not rows:
+                return
+            try:
+                get_sheet("Feedback").append_rows(rows, value_input_option='RAW')
+            except Exception:
+                with _feedback_queue_lock:
+                    _feedback_queue.extendleft(reversed(rows))
+                raise
+            # The cached Feedback values no longer include the new rows.
+            clear_sheet_cache("Feedback")
+
+def _feedback_writer():
+    retry_delay = FEEDBACK_FLUSH_INTERVAL
+    while True:
+        _feedback_flush_event.wait(FEEDBACK_FLUSH_INTERVAL)
+        _feedback_flush_event.clear()
+        try:
+            flush_feedback_rows()
+            retry_delay = FEEDBACK_FLUSH_INTERVAL
+        except Exception:
+            app.logger.error(f"Could not write {len(_feedback_queue)} queued feedback rows, retrying in {retry_delay}s.", exc_info=True)
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, FEEDBACK_MAX_RETRY_DELAY)
+
+def _flush_feedback_on_exit():
+    try:
+        flush_feedback_rows()
+    except Exception:
+        app.logger.error("Could not write queued feedback rows on shutdown.", exc_info=True)
+        with _feedback_queue_lock:
+            rows = list(_feedback_queue)
+            _feedback_queue.clear()
+        _log_dropped_feedback_rows(rows, "shutdown")
+
+threading.Thread(target=_feedback_writer, name="feedback-writer", daemon=True).start()
+atexit.register(_flush_feedback_on_exit)
+
+# --- GEMINI HELPER FUNCTIONS ---
+# One shared session keeps connections to the Gemini API open between calls,
+# so we don't pay for a new TLS handshake every time. It also retries failed
+# connections, rate limits and server errors with a short backoff. Read
+# timeouts are not retried: the request may already be running (and billed),
+# and each attempt can take the full read timeout.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=2 * GEMINI_MAX_CONCURRENCY,
+    max_retries=Retry(total=3, connect=3, read=0, status=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503], allowed_methods=frozenset(['POST']), raise_on_status=False),
+))
+# (connect, read) timeouts in seconds, so a hung call can't block a worker thread forever.
+GEMINI_TIMEOUT = (5, 60)
+
+def analyze_with_gemini(text, namespace=None):
     if not GEMINI_API_KEY:
         return {"category": "Config Error", "sentiment": 0, "error": "GEMINI_API_KEY not set."}
+    key = _analysis_key(text, namespace)
+    with _analysis_lock:
+        cached_analysis = _analysis_cache.get(key)
+        future = _inflight_analyses.get(key)
+        is_owner = cached_analysis is None and future is None
+        if is_owner:
+            future = _inflight_analyses[key] = Future()
+    if cached_analysis is not None:
+        return dict(cached_analysis)
+    if not is_owner:
+        # The same feedback is already being analyzed, wait for that answer.
+        return dict(future.result())
+    try:
+        analysis = _call_gemini_analysis(text)
+    except BaseException as e:
+        with _analysis_lock:
+            del _inflight_analyses[key]
+        future.set_exception(e)
+        raise
+    with _analysis_lock:
+        # Only successful answers are cached, errors should be retried next time.
+        if not analysis['error']:
+            _analysis_cache[key] = dict(analysis)
+        del _inflight_analyses[key]
+    future.set_result(analysis)
+    return analysis
+
+# The instructions are the same for every feedback, so they are sent as the
+# system instruction and the user message carries only the feedback text.
+# This keeps the fixed rules apart from the user-supplied text. It is too short
+# to benefit from Gemini's prompt caching.
+FEEDBACK_CATEGORIES = ["Packaging", "Formula", "Color", "Smell", "Efficacy", "Side Effect", "Price", "Documentation", "Other"]
+ANALYZE_INSTRUCTIONS = f"""Analyze the following customer feedback. Provide a JSON object with two keys: "category" and "sentiment". The "category" must be one of the following: [{', '.join(FEEDBACK_CATEGORIES)}]. The "sentiment" must be a number between -1.0 (very negative) and 1.0 (very positive)."""
+_ANALYZE_HEAD = 'Feedback to analyze: "'
+_ANALYZE_TAIL = '"'
+# Asking for JSON with a schema means Gemini answers with the bare object,
+# no markdown fences, and the category is always one of ours.
+ANALYZE_GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "OBJECT",
+        "properties": {
+            "category": {"type": "STRING", "enum": FEEDBACK_CATEGORIES},
+            "sentiment": {"type": "NUMBER"},
+        },
+        "required": ["category", "sentiment"],
+    },
+}
+
+def _call_gemini_analysis(text):
     url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={GEMINI_API_KEY}"
-    prompt = f"""Analyze the following customer feedback. Provide a JSON object with two keys: "category" and "sentiment". The "category" must be one of the following: [Packaging, Formula, Color, Smell, Efficacy, Side Effect, Price, Documentation, Other]. The "sentiment" must be a number between -1.0 (very negative) and 1.0 (very positive). Feedback to analyze: \"{text}\""""
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    payload = {
+        "systemInstruction": {"parts": [{"text": ANALYZE_INSTRUCTIONS}]},
+        "contents": [{"role": "user", "parts": [{"text": _ANALYZE_HEAD + text + _ANALYZE_TAIL}]}],
+        "generationConfig": ANALYZE_GENERATION_CONFIG,
+    }
     headers = {'Content-Type': 'application/json'}
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = SESSION.post(url, data=orjson.dumps(payload), headers=headers, timeout=GEMINI_TIMEOUT)
         response.raise_for_status()
-        json_response = response.json()
+        json_response = orjson.loads(response.content)
         model_response_text = json_response['candidates'][0]['content']['parts'][0]['text']
-        clean_json_string = model_response_text.replace('```json', '').replace('```', '').strip()
-        analysis = json.loads(clean_json_string)
+        analysis = orjson.loads(model_response_text)
         return {"category": analysis.get('category', 'Parse Error'), "sentiment": analysis.get('sentiment', 0), "error": ""}
     except Exception as e:
         app.logger.error(f"Gemini API Error: {e}", exc_info=True)
         return {"category": "AI_Error", "sentiment": 0, "error": str(e)}
 
 def generate_text_with_gemini(prompt):
-    # ... (code is identical to your version)
     if not GEMINI_API_KEY:
         return "Error: GEMINI_API_KEY not set."
     url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={GEMINI_API_KEY}"
     payload = {"contents": [{"parts": [{"text": prompt}]}]}
     headers = {'Content-Type': 'application/json'}
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = SESSION.post(url, data=orjson.dumps(payload), headers=headers, timeout=GEMINI_TIMEOUT)
         response.raise_for_status()
-        json_response = response.json()
+        json_response = orjson.loads(response.content)
         return json_response['candidates'][0]['content']['parts'][0]['text']
     except Exception as e:
         app.logger.error(f"Gemini text generation error: {e}", exc_info=True)
         return "Error: Could not generate report text from AI."
 
+# Filled in with str.format_map, only {lang} and {data_summary_for_prompt} change per call.
+REPORT_PROMPT_TEMPLATE = """You are a senior business analyst for a pharmaceutical company. Your task is to write a concise, professional executive summary report based on the following customer feedback data. The data gives the number of feedbacks per category with their average sentiment, followed by the strongest example comments for each category. Feedback listed as Unanalyzed could not be categorized automatically, read its text yourself. IMPORTANT: The entire report must be written in {lang}. The report should include these sections: 1. **Overall Summary:** A brief, high-level overview of the findings. 2. **Key Positive Themes:** What are customers consistently happy about? 3. **Key Areas for Improvement:** What are the most common complaints? Group similar issues. 4. **Actionable Recommendations:** Suggest 2-3 specific, concrete actions the company should take. Do not just list the data. Synthesize it into an insightful report in {lang}. --- DATA --- {data_summary_for_prompt} --- END OF DATA --- """
+
+REPORT_EXAMPLES_PER_CATEGORY = 3
+# Feedback whose AI analysis failed is reported under this name, without a sentiment.
+UNANALYZED_CATEGORY = 'Unanalyzed'
+
+def _sentiment_of(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _summarize_feedback(rows):
+    # Sending every row makes the prompt grow with the sheet. Instead we send
+    # the count and average sentiment per category, plus the few comments with
+    # the strongest sentiment, which is what the report is written from.
+    rows_by_category = {}
+    for row in rows:
+        # Rows whose analysis failed have no real category or sentiment, but
+        # the customer's text is still worth reporting.
+        if feedback_cell(row, 'error'):
+            category = UNANALYZED_CATEGORY
+        else:
+            category = feedback_cell(row, 'category') or 'Uncategorized'
+        rows_by_category.setdefault(category, []).append(row)
+    counts = Counter({category: len(category_rows) for category, category_rows in rows_by_category.items()})
+
+    # csv quotes cells that contain commas or newlines, so the rows stay readable for the model.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['category', 'feedbackCount', 'averageSentiment'])
+    for category, count in counts.most_common():
+        if category == UNANALYZED_CATEGORY:
+            writer.writerow([category, count, ''])
+            continue
+        average = sum(_sentiment_of(feedback_cell(row, 'sentiment')) for row in rows_by_category[category]) / count
+        writer.writerow([category, count, f"{average:.2f}"])
+    writer.writerow([])
+    writer.writerow(['category', 'sentiment', 'feedbackText', 'suggestionText'])
+    for category, _ in counts.most_common():
+        examples = heapq.nlargest(REPORT_EXAMPLES_PER_CATEGORY, rows_by_category[category], key=lambda row: abs(_sentiment_of(feedback_cell(row, 'sentiment'))))
+        for row in examples:
+            sentiment = '' if category == UNANALYZED_CATEGORY else feedback_cell(row, 'sentiment')
+            writer.writerow([category, sentiment, feedback_cell(row, 'feedbackText'), feedback_cell(row, 'suggestionText')])
+    return buffer.getvalue()
+
+def _generate_report_section(rows, lang):
+    data_summary_for_prompt = _summarize_feedback(rows)
+    report_prompt = REPORT_PROMPT_TEMPLATE.format_map({"lang": lang, "data_summary_for_prompt": data_summary_for_prompt})
+    return generate_text_with_gemini(report_prompt)
+
+# python-docx reads its default template from disk on every docx.Document()
+# call. We read it once here and build each report from the bytes in memory.
+with open(os.path.join(os.path.dirname(docx.__file__), 'templates', 'default.docx'), 'rb') as template_file:
+    DOCX_TEMPLATE_BYTES = template_file.read()
+
+# --- BACKGROUND PROCESSING ---
+# The Gemini call takes a few seconds. We run it in a thread pool so the
+# request can return right away instead of holding the worker.
+EXECUTOR = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY, thread_name_prefix="feedback")
+
+def _process_feedback(task_id, timestamp, data, analysis_text):
+    try:
+        ai_analysis = analyze_with_gemini(analysis_text, namespace=data.get('productName'))
+    except Exception as e:
+        # The client was already told the feedback was accepted, so keep it even without an analysis.
+        app.logger.error(f"Could not analyze feedback task {task_id}", exc_info=True)
+        ai_analysis = {"category": "AI_Error", "sentiment": 0, "error": str(e)}
+    # Same order as FEEDBACK_COLUMNS.
+    new_row = [timestamp, data.get('productName'), data.get('feedbackText'), data.get('suggestionText'), data.get('clientName'), data.get('clientEmail'), ai_analysis['category'], ai_analysis['sentiment'], ai_analysis['error']]
+    queue_feedback_row(new_row)
+
 
 # --- API ENDPOINTS (ROUTES) ---
 
@@ -84,33 +492,45 @@ def generate_text_with_gemini(prompt):
 def health_check():
     # This is a new endpoint for debugging.
     try:
-        # Try to connect to a sheet to test the whole connection.
-        get_sheet("Feedback") 
+        # Read from a sheet to test the whole connection.
+        get_sheet("Feedback").row_values(1)
         return jsonify({"status": "ok", "message": "Server is running and can connect to Google Sheets."})
     except Exception as e:
         app.logger.error(f"Health check failed: {str(e)}")
+        # Drop the cached connection so the next request builds a fresh one.
+        reset_sheet_connection()
         return jsonify({"status": "error", "message": f"Server is running, but database connection failed: {str(e)}"}), 500
 
 @app.route('/get-products', methods=['GET'])
 def get_products():
     try:
-        products_sheet = get_sheet("Products")
-        products = products_sheet.col_values(1)[1:] 
+        products = _load_products()
         return jsonify({"status": "success", "products": products})
     except Exception as e:
         app.logger.error("An error occurred in /get-products", exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/invalidate-cache', methods=['POST'])
+def invalidate_cache():
+    # Call this after editing a sheet by hand so the change shows up right away.
+    # It clears the cache of every worker on this server.
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode()):
+        return jsonify({"status": "error", "message": "Not authorized."}), 403
+    invalidate_all_sheet_caches()
+    return jsonify({"status": "success", "message": "Sheets cache cleared for all workers."})
+
 @app.route('/submit-feedback', methods=['POST'])
 def submit_feedback():
     try:
-        feedback_sheet = get_sheet("Feedback")
         data = request.json
-        ai_analysis = analyze_with_gemini(f"Feedback: {data['feedbackText']}. Suggestion: {data['suggestionText']}")
-        timestamp = datetime.utcnow().isoformat() + "Z" 
-        new_row = [timestamp, data.get('productName'), data.get('feedbackText'), data.get('suggestionText'), data.get('clientName'), data.get('clientEmail'), ai_analysis['category'], ai_analysis['sentiment'], ai_analysis['error']]
-        feedback_sheet.append_row(new_row)
-        return jsonify({"status": "success", "message": "Feedback submitted."})
+        analysis_text = f"Feedback: {data['feedbackText']}. Suggestion: {data['suggestionText']}"
+        # The row is written later, so check now that the Feedback sheet can be reached.
+        get_sheet("Feedback")
+        timestamp = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        task_id = uuid.uuid4().hex
+        EXECUTOR.submit(_process_feedback, task_id, timestamp, data, analysis_text)
+        return jsonify({"status": "success", "message": "Feedback submitted.", "taskId": task_id}), 202
     except Exception as e:
         app.logger.error("An error occurred in /submit-feedback", exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -118,12 +538,14 @@ def submit_feedback():
 @app.route('/admin-login', methods=['POST'])
 def admin_login():
     try:
-        admin_sheet = get_sheet("AdminUsers")
         data = request.json
-        users = admin_sheet.get_all_records()
-        for user in users:
-            if user['Username'] == data['username'] and str(user['Password']) == data['password']:
-                return jsonify({"status": "success", "message": "Login successful."})
+        username, password = data['username'], data['password']
+        if not isinstance(username, str) or not isinstance(password, str):
+            return jsonify({"status": "error", "message": "Invalid credentials."}), 401
+        stored_password = _load_admins().get(username)
+        # compare_digest runs in constant time, so timing does not reveal how much of the password matched.
+        if stored_password is not None and hmac.compare_digest(stored_password.encode(), password.encode()):
+            return jsonify({"status": "success", "message": "Login successful."})
         return jsonify({"status": "error", "message": "Invalid credentials."}), 401
     except Exception as e:
         app.logger.error("An error occurred in /admin-login", exc_info=True)
@@ -132,9 +554,9 @@ def admin_login():
 @app.route('/get-all-feedback', methods=['GET'])
 def get_all_feedback():
     try:
-        feedback_sheet = get_sheet("Feedback")
-        all_feedback = feedback_sheet.get_all_records()
-        return jsonify({"status": "success", "feedback": all_feedback})
+        # Sent as one header list plus a list of rows. This is much smaller than one object per row.
+        headers, rows = _load_table("Feedback")
+        return jsonify({"status": "success", "feedback": {"headers": headers, "rows": rows}})
     except Exception as e:
         app.logger.error("An error occurred in /get-all-feedback", exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -142,21 +564,25 @@ def get_all_feedback():
 @app.route('/generate-report', methods=['GET'])
 def generate_report():
     try:
-        feedback_sheet = get_sheet("Feedback")
         lang = request.args.get('lang', 'english')
-        all_feedback = feedback_sheet.get_all_records()
-        if not all_feedback:
+        _, rows = _load_table("Feedback")
+        if not rows:
             return jsonify({"status": "error", "message": "No feedback data to generate a report."}), 404
-        # ... (rest of report generation is identical to your version)
-        data_summary_for_prompt = "\n".join([str(item) for item in all_feedback])
-        report_prompt = f"""You are a senior business analyst for a pharmaceutical company. Your task is to write a concise, professional executive summary report based on the following raw customer feedback data. IMPORTANT: The entire report must be written in {lang}. The report should include these sections: 1. **Overall Summary:** A brief, high-level overview of the findings. 2. **Key Positive Themes:** What are customers consistently happy about? 3. **Key Areas for Improvement:** What are the most common complaints? Group similar issues. 4. **Actionable Recommendations:** Suggest 2-3 specific, concrete actions the company should take. Do not just list the data. Synthesize it into an insightful report in {lang}. --- RAW DATA --- {data_summary_for_prompt} --- END OF RAW DATA --- """
-        generated_report_text = generate_text_with_gemini(report_prompt)
-        document = docx.Document()
+        # Each product gets its own section, and the sections are written by Gemini in parallel.
+        feedback_by_product = {}
+        for row in rows:
+            feedback_by_product.setdefault(feedback_cell(row, 'productName') or 'Unspecified product', []).append(row)
+        with ThreadPoolExecutor(max_workers=min(len(feedback_by_product), GEMINI_MAX_CONCURRENCY)) as report_executor:
+            sections = list(report_executor.map(lambda product_rows: _generate_report_section(product_rows, lang), feedback_by_product.values()))
+        document = docx.Document(io.BytesIO(DOCX_TEMPLATE_BYTES))
         document.add_heading('Customer Feedback Report', level=0)
-        for paragraph in generated_report_text.split('\n'):
-            if paragraph.strip():
-                document.add_paragraph(paragraph)
-        file_stream = BytesIO()
+        for product_name, generated_report_text in zip(feedback_by_product, sections):
+            if len(feedback_by_product) > 1:
+                document.add_heading(str(product_name), level=1)
+            for paragraph in generated_report_text.split('\n'):
+                if paragraph.strip():
+                    document.add_paragraph(paragraph)
+        file_stream = io.BytesIO()
         document.save(file_stream)
         file_stream.seek(0)
         return send_file( file_stream, as_attachment=True, download_name=f'Pharma_Feedback_Report_{lang}.docx', mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')